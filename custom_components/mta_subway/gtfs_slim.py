@@ -0,0 +1,76 @@
+"""
+Trimmed GTFS-realtime schema with only the fields the sensor reads.
+
+Field numbers match gtfs-realtime.proto, so the MTA feeds parse into these
+messages directly. Everything else (vehicle positions, alerts, delays, the
+NYCT extensions, ...) is unknown to this schema and is skipped as raw bytes
+instead of being decoded into submessages.
+
+The schema is built at runtime rather than generated with protoc so it
+works with any protobuf version.
+"""
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+_PACKAGE = "mta_subway.gtfs_slim"
+
+_FieldProto = descriptor_pb2.FieldDescriptorProto
+
+
+def _field(name, number, field_type, type_name=None, repeated=False):
+    field = _FieldProto(
+        name=name,
+        number=number,
+        type=field_type,
+        label=_FieldProto.LABEL_REPEATED if repeated else _FieldProto.LABEL_OPTIONAL)
+    if type_name is not None:
+        field.type_name = ".{}.{}".format(_PACKAGE, type_name)
+    return field
+
+
+def _message(name, *fields):
+    return descriptor_pb2.DescriptorProto(name=name, field=fields)
+
+
+_FILE = descriptor_pb2.FileDescriptorProto(
+    name="mta_subway/gtfs_slim.proto",
+    package=_PACKAGE,
+    syntax="proto2",
+    message_type=[
+        _message(
+            "FeedMessage",
+            _field("header", 1, _FieldProto.TYPE_MESSAGE, "FeedHeader"),
+            _field("entity", 2, _FieldProto.TYPE_MESSAGE, "FeedEntity", repeated=True)),
+        _message(
+            "FeedHeader",
+            _field("timestamp", 3, _FieldProto.TYPE_UINT64)),
+        _message(
+            "FeedEntity",
+            _field("trip_update", 3, _FieldProto.TYPE_MESSAGE, "TripUpdate")),
+        _message(
+            "TripUpdate",
+            _field("trip", 1, _FieldProto.TYPE_MESSAGE, "TripDescriptor"),
+            _field("stop_time_update", 2, _FieldProto.TYPE_MESSAGE, "StopTimeUpdate", repeated=True)),
+        _message(
+            "TripDescriptor",
+            _field("route_id", 5, _FieldProto.TYPE_STRING)),
+        _message(
+            "StopTimeUpdate",
+            _field("arrival", 2, _FieldProto.TYPE_MESSAGE, "StopTimeEvent"),
+            _field("stop_id", 4, _FieldProto.TYPE_STRING)),
+        _message(
+            "StopTimeEvent",
+            _field("time", 2, _FieldProto.TYPE_INT64)),
+    ])
+
+_pool = descriptor_pool.DescriptorPool()
+_pool.AddSerializedFile(_FILE.SerializeToString())
+
+try:
+    _get_message_class = message_factory.GetMessageClass
+except AttributeError:
+    # protobuf < 4.21
+    _get_message_class = message_factory.MessageFactory(_pool).GetPrototype
+
+FeedMessage = _get_message_class(
+    _pool.FindMessageTypeByName(_PACKAGE + ".FeedMessage"))
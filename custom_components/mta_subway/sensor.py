@@ -2,69 +2,150 @@
 Sensor for checking the status of NYC MTA Subway lines.
 """
 
+import asyncio
 import logging
 import re
 from datetime import timedelta
 
+import aiohttp
 import homeassistant.helpers.config_validation as cv
-import requests
 import voluptuous as vol
 from homeassistant.components.sensor import PLATFORM_SCHEMA
-from homeassistant.helpers.entity import Entity
-from homeassistant.util import Throttle
+from homeassistant.core import callback
+from homeassistant.exceptions import PlatformNotReady
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.update_coordinator import (
+    CoordinatorEntity,
+    DataUpdateCoordinator,
+    UpdateFailed,
+)
 
 import csv
-from google.transit import gtfs_realtime_pb2
+from google.protobuf.internal import api_implementation
 import json
-from collections import defaultdict
-import math
-from requests_toolbelt.threaded import pool
+from collections import namedtuple
+import heapq
+import operator
 import time
 from typing import List
 
+from . import gtfs_slim
+
 _LOGGER = logging.getLogger(__name__)
 
+PROTOBUF_IMPLEMENTATION = api_implementation.Type()
+if PROTOBUF_IMPLEMENTATION == "python":
+    _LOGGER.warning(
+        "protobuf is using the pure-Python implementation, parsing the "
+        "realtime feeds will be slow. Install a protobuf wheel with the "
+        "C extension (cpp or upb) for better performance.")
+
 CONF_API_KEY = "api_key"
 CONF_STATION = "station"
+CONF_DAYTIME_FEEDS_ONLY = "daytime_feeds_only"
 SCAN_INTERVAL = timedelta(seconds=20)
+STATIONS_SCAN_INTERVAL = timedelta(hours=1)
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Number of upcoming arrivals kept per station.
+MAX_ARRIVALS = 8
 
 # http://datamine.mta.info/list-of-feeds
 FEED_IDS = [1, 26, 16, 21, 2, 11, 31, 36, 51 ]
+FEED_URL = "http://datamine.mta.info/mta_esi.php?key={}&feed_id={}"
+
+# Routes carried by each feed, using the labels from the "Daytime Routes"
+# column of Stations.csv. Only used when CONF_DAYTIME_FEEDS_ONLY is set, since
+# night, weekend and rerouted service can stop at a station from other feeds.
+FEED_ROUTES = {
+    1: frozenset(["1", "2", "3", "4", "5", "6", "S"]),
+    26: frozenset(["A", "C", "E", "S"]),
+    16: frozenset(["N", "Q", "R", "W"]),
+    21: frozenset(["B", "D", "F", "M"]),
+    2: frozenset(["L"]),
+    11: frozenset(["SIR"]),
+    31: frozenset(["G"]),
+    36: frozenset(["J", "Z"]),
+    51: frozenset(["7"]),
+}
+
+
+# Direction suffix of a stop id -> (Station field with its label, name suffix).
+DIRECTIONS = {
+    "N": ("north_direction_label", "Uptown"),
+    "S": ("south_direction_label", "Downtown"),
+}
+
+Station = namedtuple("Station", [
+    "stop_name",
+    "south_direction_label",
+    "north_direction_label",
+    "complex_id",
+    "daytime_routes",
+])
+
+# Arrivals for a station are kept as parallel columns, in this field order.
+ARRIVAL_FIELDS = ("time", "line", "last_updated")
+NO_ARRIVALS = ((), (), ())
+
+_get_stop_time_update_fields = operator.attrgetter("stop_id", "arrival.time")
+
+
+def minutes_until(arrival_time, current_time):
+    """ Returns the whole minutes until arrival_time, rounded up.
+    """
+    return -((current_time - arrival_time) // 60)
 
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_STATION): cv.ensure_list,
-    vol.Required(CONF_API_KEY): cv.string
+    vol.Required(CONF_API_KEY): cv.string,
+    vol.Optional(CONF_DAYTIME_FEEDS_ONLY, default=False): cv.boolean
 })
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """ Sets up the MTA Subway sensors.
     """
+    _LOGGER.debug("Using protobuf implementation: {}".format(PROTOBUF_IMPLEMENTATION))
     api_key = config.get(CONF_API_KEY)
     stations = config.get(CONF_STATION)
-    data = MTASubwayData(api_key, stations)
-    data.update()
+    daytime_feeds_only = config.get(CONF_DAYTIME_FEEDS_ONLY)
+    data = MTASubwayData(hass, api_key, stations, daytime_feeds_only)
+    coordinator = DataUpdateCoordinator(
+        hass,
+        _LOGGER,
+        name="mta_subway",
+        update_method=data.async_update,
+        update_interval=SCAN_INTERVAL,
+    )
+    await coordinator.async_refresh()
+    if not coordinator.last_update_success:
+        raise PlatformNotReady
     sensors = [
-        MTASubwaySensor(station, data)
+        MTASubwaySensor(station, coordinator)
         for station in config.get(CONF_STATION)
     ]
-    add_devices(sensors, True)
+    async_add_entities(sensors)
 
 
-class MTASubwaySensor(Entity):
+class MTASubwaySensor(CoordinatorEntity):
     """ Sensor that reads the status for an MTA Subway line.
     """
-    def __init__(self, station_id, data):
+    def __init__(self, station_id, coordinator):
         """ Initalize the sensor.
         """
+        super().__init__(coordinator)
         self._name = None
         self._station_id = station_id
-        self._data = data
-        self._state = None
-        self._arrivals = None
+        self._top = None
         self._station_name = None
         self._station_direction_label = None
+        self._direction = DIRECTIONS.get(station_id[-1:])
+        if self._direction is None:
+            _LOGGER.error("Bad station id: {}".format(station_id))
+        self.__update_station_info()
+        self.__update_from_data()
 
     @property
     def name(self):
@@ -76,7 +157,9 @@ class MTASubwaySensor(Entity):
     def state(self):
         """ Returns the state of the sensor.
         """
-        return self._state
+        if self._top is None:
+            return None
+        return self._top[0]
 
     @property
     def icon(self):
@@ -88,8 +171,10 @@ class MTASubwaySensor(Entity):
     def entity_picture(self):
         """ Returns the icon used for the frontend.
         """
+        if self._top is None:
+            return None
         try: 
-            line = self._arrivals[0]["line"].lower()[0]
+            line = self._top[1].lower()[0]
             return "/community_plugin/lovelace-mta-subway-realtime/public/{}.svg".format(line)
         except Exception:
             _LOGGER.debug("Couldn't set entity_picture")
@@ -103,49 +188,51 @@ class MTASubwaySensor(Entity):
     def device_state_attributes(self):
         """ Returns the attributes of the sensor.
         """
+        current_time = int(time.time())
         attrs = {}
-        attrs["arrivals"] = self._arrivals
+        attrs["arrivals"] = [
+            dict(zip(ARRIVAL_FIELDS, arrival),
+                 time_until=minutes_until(arrival[0], current_time))
+            for arrival in zip(*self._arrivals)
+        ]
         attrs["station_name"] = self._station_name
         attrs["station_direction_label"] = self._station_direction_label
         return attrs
     
     @property
     def unit_of_measurement(self):
-        try: 
-            return "{} min".format(self._data.data["arrivals"][self._station_id][0]["time_until"])
-        except Exception:
-            _LOGGER.debug("Failed to set unit_of_measurement")
+        if self._top is None:
             return None
+        return "{} min".format(minutes_until(self._top[0], int(time.time())))
 
     @property
     def unique_id(self):
         return "mta_subway_" + self._station_id
 
-    def update(self):
-        """ Updates the sensor.
+    @callback
+    def _handle_coordinator_update(self):
+        """ Updates the sensor from freshly fetched coordinator data.
         """
-        self._data.update()
-        station_data = self._data.data["arrivals"][self._station_id]
-        try:
-            self._state = station_data[0]["time"]
-            self._arrivals = self._data.data["arrivals"][self._station_id]
-
-            stop_id_without_direction = self._station_id[:-1]
-            
-            if self._station_id.endswith("N"):
-                self._station_direction_label = self._data.data["stations"][stop_id_without_direction]["north_direction_label"]
-                self._name = "MTA: " + self._data.data["stations"][stop_id_without_direction]["stop_name"] + " Uptown"
-            elif self._station_id.endswith("S"):
-                self._station_direction_label = self._data.data["stations"][stop_id_without_direction]["south_direction_label"]
-                self._name = "MTA: " + self._data.data["stations"][stop_id_without_direction]["stop_name"] + " Downtown"
-            else:
-                raise Exception("Bad station id: {}".format(self._station_id))
-
-            self._station_name = self._data.data["stations"][stop_id_without_direction]["stop_name"]
+        self.__update_from_data()
+        super()._handle_coordinator_update()
 
-            #self._name = "MTA Subway Station " + self._station_name + " towards " + self._station_direction_label
-        except Exception:
-            _LOGGER.exception("Error updating sensor")
+    def __update_station_info(self):
+        """ Sets the name and labels, which only depend on the station id.
+        """
+        station = self.coordinator.data["stations"].get(self._station_id[:-1])
+        if station is None or self._direction is None:
+            _LOGGER.debug("No station information for {}".format(self._station_id))
+            return
+        label_field, name_suffix = self._direction
+        self._station_name = station.stop_name
+        self._station_direction_label = getattr(station, label_field)
+        self._name = "MTA: {} {}".format(station.stop_name, name_suffix)
+
+    def __update_from_data(self):
+        if self._name is None:
+            self.__update_station_info()
+        self._arrivals = self.coordinator.data["arrivals"].get(self._station_id, NO_ARRIVALS)
+        self._top = next(zip(*self._arrivals), None)
 
 
 class MTASubwayData(object):
@@ -153,93 +240,182 @@ class MTASubwayData(object):
     """
 
 
-    def __get_stations(self):
+    async def __get_stations(self):
         _LOGGER.debug("Fetching station information")
         url = "http://web.mta.info/developers/data/nyct/subway/Stations.csv"
-        r = requests.get(url)
-        reader = csv.DictReader(r.text.splitlines(), delimiter=',')
+        async with self._session.get(url, timeout=FETCH_TIMEOUT) as r:
+            r.raise_for_status()
+            text = await r.text()
+        reader = csv.reader(text.splitlines(), delimiter=',')
+        header = {column: i for i, column in enumerate(next(reader))}
+        stop_id_i = header["GTFS Stop ID"]
+        stop_name_i = header["Stop Name"]
+        south_i = header["South Direction Label"]
+        north_i = header["North Direction Label"]
+        complex_id_i = header["Complex ID"]
+        # Only needed to pick feeds, so don't fail if the column goes away.
+        routes_i = header.get("Daytime Routes") if self._daytime_feeds_only else None
+        max_i = max(stop_id_i, stop_name_i, south_i, north_i, complex_id_i,
+                    routes_i if routes_i is not None else 0)
         result = {}
         for row in reader:
-            stop_name = row["Stop Name"]
-            result[row["GTFS Stop ID"]] = {
-                "stop_name": stop_name,
-                "south_direction_label": row["South Direction Label"],
-                "north_direction_label": row["North Direction Label"],
-                "complex_id": row["Complex ID"]
-            }
-            #result[row["GTFS Stop ID"]+"N"] = stop_name + " - " + row["North Direction Label"]
+            # csv.reader yields [] for blank lines and short rows for truncated ones.
+            if len(row) <= max_i:
+                continue
+            if row[stop_id_i] not in self._watched_parents:
+                continue
+            result[row[stop_id_i]] = Station(
+                row[stop_name_i],
+                row[south_i],
+                row[north_i],
+                row[complex_id_i],
+                frozenset(row[routes_i].split()) if routes_i is not None else frozenset())
         _LOGGER.debug("Got station information")
         return result
 
-    def __get_realtime_data(self) -> List[gtfs_realtime_pb2.FeedMessage]:
+    async def __fetch(self, url):
+        _LOGGER.debug("GET {}".format(url))
+        async with self._session.get(url, timeout=FETCH_TIMEOUT) as response:
+            # Always read the body so the connection goes back to the pool.
+            return response.status, await response.read()
+
+    async def __get_realtime_data(self) -> List[bytes]:
         _LOGGER.debug("Fetching realtime data...")
-        urls = ['http://datamine.mta.info/mta_esi.php?key={}&feed_id={}'.format(self.api_key, feed_id) for feed_id in FEED_IDS]
+        urls = [
+            url for feed_id, url in zip(FEED_IDS, self._feed_urls)
+            if feed_id in self._relevant_feeds
+        ]
 
-        for url in urls:
-            _LOGGER.debug("GET {}".format(url))
-        p = pool.Pool.from_urls(urls)
-        p.join_all()
+        responses = await asyncio.gather(
+            *[self.__fetch(url) for url in urls], return_exceptions=True)
 
         data = []
 
-        for response in p.responses():
-            #_LOGGER.debug('Fetched realtime data: GET {0}. Returned {1}.'.format(response.request_kwargs['url'], response.status_code))
-            if response.status_code != 200:
-                _LOGGER.error("Non-200 response while fetching {}".format(response.request_kwargs['url']))
+        for url, response in zip(urls, responses):
+            if isinstance(response, Exception):
+                _LOGGER.error("Error while fetching {}: {}".format(url, response))
+                continue
+            status, body = response
+            if status != 200:
+                _LOGGER.error("Non-200 response while fetching {}".format(url))
             else:
-                try:
-                    feed = gtfs_realtime_pb2.FeedMessage()
-                    feed.ParseFromString(response.content)
-                    data.append(feed)
-
-                except Exception:
-                    _LOGGER.exception("Failure to parse fetched message")
-                    _LOGGER.debug(response.text)
+                data.append(body)
 
         return data
 
-    def __init__(self, api_key, watched_stations):
+    def __parse_arrivals(self, payloads, stations):
+        """ Parses the feed payloads and collects the next arrivals at watched
+        stations. This is CPU bound and runs in the executor.
+        """
+        # One bucket per watched stop we have station info for, so a single
+        # dict lookup both filters and groups each stop time update.
+        arrivals = {
+            stop_id: ([], [], [])
+            for stop_id in self._watched_set if stop_id[:-1] in stations
+        }
+        feed = gtfs_slim.FeedMessage()
+        # Bound to locals for the inner loop.
+        get_fields = _get_stop_time_update_fields
+        get_bucket = arrivals.get
 
-        self.data = None
-        self.api_key = api_key
-        self.watched_stations = watched_stations
+        for body in payloads:
+            try:
+                feed.ParseFromString(body)
+            except Exception:
+                _LOGGER.exception("Failure to parse fetched message ({} bytes)".format(len(body)))
+                continue
 
-    @Throttle(SCAN_INTERVAL)
-    def update(self):
-        """ Update data based on SCAN_INTERVAL.
-        """
+            last_updated = feed.header.timestamp
 
-        stations = self.__get_stations()
-        realtime_data = self.__get_realtime_data()
+            for entity in feed.entity:
+                if entity.HasField("trip_update"):
+                    trip_update = entity.trip_update
+                    route_id = trip_update.trip.route_id
 
+                    for stop_time_update in trip_update.stop_time_update:
+                        stop_id, arrival_time = get_fields(stop_time_update)
 
-        arrivals = defaultdict(list)
+                        bucket = get_bucket(stop_id)
+                        if bucket is not None:
+                            times, lines, updated = bucket
+                            times.append(arrival_time)
+                            lines.append(route_id)
+                            updated.append(last_updated)
 
-        current_time = int(time.time())
 
-        for feed in realtime_data:
-            header = feed.header
+        result = {}
+        for stop_id, (times, lines, updated) in arrivals.items():
+            if not times:
+                continue
+            order = heapq.nsmallest(
+                MAX_ARRIVALS, range(len(times)), key=times.__getitem__)
+            result[stop_id] = (
+                [times[i] for i in order],
+                [lines[i] for i in order],
+                [updated[i] for i in order])
+        return result
 
-            for entity in feed.entity:
-                if entity.HasField("trip_update"):
-                    trip = entity.trip_update.trip
-                    
-                    for stop_time_update in entity.trip_update.stop_time_update:
-                        stop_id = stop_time_update.stop_id
-                        stop_id_without_direction = stop_id[:-1]
-
-                        if stop_id in self.watched_stations and stop_id_without_direction in stations:
-                            arrivals[stop_id].append({
-                                "time": stop_time_update.arrival.time,
-                                "line": trip.route_id,
-                                "last_updated": header.timestamp,
-                                "time_until": math.ceil(float(stop_time_update.arrival.time - current_time) / 60)
-                                })
-
-        for k,v in arrivals.items():
-            v.sort(key=lambda x:x["time"])
-        
-        self.data = {
+    def __init__(self, hass, api_key, watched_stations, daytime_feeds_only=False):
+
+        self._hass = hass
+        self._session = async_get_clientsession(hass)
+        self._lock = asyncio.Lock()
+        self._feed_urls = [FEED_URL.format(api_key, feed_id) for feed_id in FEED_IDS]
+        self._watched_set = frozenset(watched_stations)
+        self._watched_parents = frozenset(s[:-1] for s in watched_stations)
+        self._stations = None
+        self._stations_updated_at = None
+        self._daytime_feeds_only = daytime_feeds_only
+        self._relevant_feeds = frozenset(FEED_IDS)
+
+    def __get_relevant_feeds(self, stations):
+        """ Returns the ids of the feeds serving any of the watched stations.
+        Every feed is relevant unless CONF_DAYTIME_FEEDS_ONLY is set.
+        """
+        if not self._daytime_feeds_only:
+            return frozenset(FEED_IDS)
+        routes = set()
+        for parent in self._watched_parents:
+            if parent not in stations or not stations[parent].daytime_routes:
+                # Can't tell which feeds serve this station, so keep them all.
+                return frozenset(FEED_IDS)
+            routes.update(stations[parent].daytime_routes)
+        return frozenset(
+            feed_id for feed_id in FEED_IDS if FEED_ROUTES[feed_id] & routes)
+
+    async def __async_update_stations(self):
+        """ Refresh station metadata based on STATIONS_SCAN_INTERVAL.
+        """
+        if (self._stations_updated_at is not None and
+                time.monotonic() - self._stations_updated_at < STATIONS_SCAN_INTERVAL.total_seconds()):
+            return
+        try:
+            self._stations = await self.__get_stations()
+            self._relevant_feeds = self.__get_relevant_feeds(self._stations)
+            _LOGGER.debug("Fetching feeds: {}".format(sorted(self._relevant_feeds)))
+        except Exception as err:
+            if self._stations is None:
+                raise UpdateFailed("Failed to fetch station information: {}".format(err))
+            _LOGGER.exception("Failed to refresh station information, keeping cached copy")
+        self._stations_updated_at = time.monotonic()
+
+    async def async_update(self):
+        """ Fetch and parse the realtime feeds. Called by the coordinator every
+        SCAN_INTERVAL.
+        """
+        # The coordinator doesn't serialize refreshes: a requested refresh can
+        # start while a scheduled one is still fetching.
+        async with self._lock:
+            return await self.__async_update()
+
+    async def __async_update(self):
+        await self.__async_update_stations()
+        stations = self._stations
+        payloads = await self.__get_realtime_data()
+        arrivals = await self._hass.async_add_executor_job(
+            self.__parse_arrivals, payloads, stations)
+
+        return {
             "stations": stations,
             "arrivals": arrivals
         }